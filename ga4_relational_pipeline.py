@@ -1,12 +1,16 @@
 import os
+import csv
 import sqlite3
 import logging
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import islice
 from dotenv import load_dotenv
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest
-from tenacity import retry, stop_after_attempt, wait_exponential
+from google.api_core.exceptions import Aborted, DeadlineExceeded, InternalServerError, ServiceUnavailable
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # Load environment variables
 load_dotenv('.env')
@@ -30,6 +34,7 @@ CONFIG = {
     },
     'database': {
         'path': 'ga4_data.db',
+        'batch_size': 10_000,
         'tables': {
             'dates': 'dates',
             'users': 'user_interaction',
@@ -39,11 +44,57 @@ CONFIG = {
     }
 }
 
+# Columns of each dataset's row tuples, used for the CSV exports and staging tables
+CSV_HEADERS = {
+    'users': ('date', 'users', 'sessions', 'engagement_rate', 'conversions', 'average_session_duration'),
+    'content': ('date', 'page_title', 'page_views', 'sessions', 'engagement_rate', 'session_duration'),
+    'site': ('date', 'search_Term', 'clicks', 'impressions')
+}
+
+# Indexes on the date_id foreign keys, keyed by index name
+DATE_ID_INDEXES = {
+    'idx_ui_date': 'user_interaction',
+    'idx_cm_date': 'content_metrics',
+    'idx_sd_date': 'site_data'
+}
 
-def init_db():
+# Staged rows are moved into the relational tables with set-based statements
+STAGED_DATES_SQL = (
+    "SELECT date FROM staging_users "
+    "UNION SELECT date FROM staging_content "
+    "UNION SELECT date FROM staging_site"
+)
+INSERT_DATES_SQL = f"INSERT OR IGNORE INTO dates (date) {STAGED_DATES_SQL} ORDER BY date"
+INSERT_USERS_SQL = (
+    "INSERT INTO user_interaction (date_id, users, sessions, engagement_rate, conversions, average_session_duration) "
+    "SELECT d.date_id, s.users, s.sessions, s.engagement_rate, s.conversions, s.average_session_duration "
+    "FROM staging_users s JOIN dates d ON d.date = s.date ORDER BY s.rowid"
+)
+INSERT_CONTENT_SQL = (
+    "INSERT INTO content_metrics (date_id, page_title, page_views, content_sessions, engagement_rate, session_duration) "
+    "SELECT d.date_id, s.page_title, s.page_views, s.sessions, s.engagement_rate, s.session_duration "
+    "FROM staging_content s JOIN dates d ON d.date = s.date ORDER BY s.rowid"
+)
+INSERT_SITE_SQL = (
+    "INSERT INTO site_data (date_id, search_Term, clicks, impressions) "
+    "SELECT d.date_id, s.search_Term, s.clicks, s.impressions "
+    "FROM staging_site s JOIN dates d ON d.date = s.date ORDER BY s.rowid"
+)
+
+
+def configure_connection(conn):
+    """Apply bulk-load friendly pragmas to a SQLite connection"""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")  # persistent, stored in the db file
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=FILE")  # staging tables spill to disk on large backfills
+    cursor.execute("PRAGMA cache_size=-65536")  # 64MB
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256MB
+
+def init_db(conn):
     """Initialize SQLite database with relational schema"""
-    conn = sqlite3.connect(CONFIG['database']['path'])
     cursor = conn.cursor()
+    cursor.execute("BEGIN")
     
     # Create tables with relationships
     cursor.execute('''
@@ -90,39 +141,35 @@ def init_db():
         )
     ''')
     
-    conn.commit()
-    conn.close()
+    create_date_id_indexes(conn)
+    
+    conn.execute("COMMIT")
     logger.info("Database initialized with relational schema")
 
-def get_or_create_date_id(date_str):
-    """Get or create date entry and return date_id"""
-    conn = sqlite3.connect(CONFIG['database']['path'])
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('''
-            SELECT date_id FROM dates WHERE date = ?
-        ''', (date_str,))
-        result = cursor.fetchone()
-        
-        if result:
-            return result[0]
-        else:
-            cursor.execute('''
-                INSERT INTO dates (date) VALUES (?)
-            ''', (date_str,))
-            conn.commit()
-            return cursor.lastrowid
-    except Exception as e:
-        logger.error(f"Date ID lookup failed: {str(e)}")
-        raise
-    finally:
-        conn.close()
+def create_date_id_indexes(conn):
+    """Create the date_id indexes on the metric tables"""
+    for index, table in DATE_ID_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} (date_id)")
+
+def drop_date_id_indexes(conn):
+    """Drop the date_id indexes on the metric tables"""
+    for index in DATE_ID_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+
+@lru_cache(maxsize=1)
+def get_ga4_client():
+    """Build the GA4 client once and reuse its channel across fetches"""
+    return BetaAnalyticsDataClient.from_service_account_json(CONFIG['ga4']['credentials'])
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
+# Only transient API errors are retried; anything else fails on the first attempt
+@retry(
+    retry=retry_if_exception_type((ServiceUnavailable, DeadlineExceeded, InternalServerError, Aborted)),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=10)
+)
 def fetch_ga4_data(start_date: str, end_date: str):
     """Fetch GA4 data for all metric categories"""
-    client = BetaAnalyticsDataClient.from_service_account_json(CONFIG['ga4']['credentials'])
+    client = get_ga4_client()
     
     try:
         # User Interaction Data
@@ -163,43 +210,62 @@ def fetch_ga4_data(start_date: str, end_date: str):
             ]
         )
         
-        # Process responses
-        user_response = client.run_report(user_request)
-        content_response = client.run_report(content_request)
-        site_response = client.run_report(site_request)
+        # Run the three independent reports concurrently
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            user_response, content_response, site_response = executor.map(
+                client.run_report, [user_request, content_request, site_request]
+            )
+        
+        if not any(response.rows for response in (user_response, content_response, site_response)):
+            return {}
         
         def process_response(response, type):
-            data = []
-            for row in response.rows:
-                ga4_date = row.dimension_values[0].value
-                formatted_date = f"{ga4_date[:4]}-{ga4_date[4:6]}-{ga4_date[6:8]}"
-                entry = {'date': formatted_date}
-                
-                if type == 'user':
-                    entry.update({
-                        'users': int(row.metric_values[0].value),
-                        'sessions': int(row.metric_values[1].value),
-                        'engagement_rate': float(row.metric_values[2].value),
-                        'conversions': int(row.metric_values[3].value),
-                        'average_session_duration': float(row.metric_values[4].value)
-                    })
-                elif type == 'content':
-                    entry.update({
-                        'page_title': row.dimension_values[1].value,
-                        'page_views': int(row.metric_values[0].value),
-                        'sessions': int(row.metric_values[1].value),
-                        'engagement_rate': float(row.metric_values[2].value),
-                        'session_duration': float(row.metric_values[3].value)
-                    })
-                elif type == 'site':
-                    entry.update({
-                        'search_Term': row.dimension_values[1].value,
-                        'clicks': int(row.metric_values[0].value),
-                        'impressions': int(row.metric_values[1].value)
-                    })
-                
-                data.append(entry)
-            return pd.DataFrame(data)
+            # Dates repeat across rows, so format each one only once
+            date_cache = {}
+            # Rows are parsed lazily as save_data consumes them, so report parse errors here
+            try:
+                for row in response.rows:
+                    # Read each repeated field once, then unpack plain Python values
+                    ga4_date, *dimensions = [value.value for value in row.dimension_values]
+                    metrics = [value.value for value in row.metric_values]
+                    
+                    formatted_date = date_cache.get(ga4_date)
+                    if formatted_date is None:
+                        formatted_date = date_cache[ga4_date] = f"{ga4_date[:4]}-{ga4_date[4:6]}-{ga4_date[6:8]}"
+                    
+                    if type == 'user':
+                        users, sessions, engagement_rate, conversions, average_session_duration = metrics
+                        yield (
+                            formatted_date,
+                            int(users),
+                            int(sessions),
+                            float(engagement_rate),
+                            int(conversions),
+                            float(average_session_duration)
+                        )
+                    elif type == 'content':
+                        page_title, = dimensions
+                        page_views, sessions, engagement_rate, session_duration = metrics
+                        yield (
+                            formatted_date,
+                            page_title,
+                            int(page_views),
+                            int(sessions),
+                            float(engagement_rate),
+                            float(session_duration)
+                        )
+                    elif type == 'site':
+                        search_term, = dimensions
+                        clicks, impressions = metrics
+                        yield (
+                            formatted_date,
+                            search_term,
+                            int(clicks),
+                            int(impressions)
+                        )
+            except (ValueError, TypeError) as e:
+                logger.error(f"GA4 {type} response parse failed: {str(e)}")
+                raise
         
         return {
             'users': process_response(user_response, 'user'),
@@ -211,90 +277,86 @@ def fetch_ga4_data(start_date: str, end_date: str):
         logger.error(f"GA4 data fetch failed: {str(e)}")
         raise
 
-def save_data(data):
+def chunks(rows, size):
+    """Yield successive lists of at most size rows from any iterable"""
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+def save_data(conn, data):
     """Save data to appropriate tables with relational integrity"""
-    conn = sqlite3.connect(CONFIG['database']['path'])
-    cursor = conn.cursor()
+    batch_size = CONFIG['database']['batch_size']
     
     try:
-        # Get unique dates from all datasets
-        all_dates = set()
-        for df in data.values():
-            all_dates.update(df['date'].unique())
+        # An empty dates table means this is the initial load
+        initial_load = conn.execute("SELECT 1 FROM dates LIMIT 1").fetchone() is None
         
-        # Create date entries first
-        date_map = {}
-        for date_str in all_dates:
-            date_id = get_or_create_date_id(date_str)
-            date_map[date_str] = date_id
-        
-        # Insert user data
-        for _, row in data['users'].iterrows():
-            cursor.execute('''
-                INSERT INTO user_interaction (
-                    date_id, users, sessions, engagement_rate, conversions, average_session_duration
-                ) VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                date_map[row['date']],
-                row['users'],
-                row['sessions'],
-                row['engagement_rate'],
-                row['conversions'],
-                row['average_session_duration']
-            ))
-        
-        # Insert content data
-        for _, row in data['content'].iterrows():
-            cursor.execute('''
-                INSERT INTO content_metrics (
-                    date_id, page_title, page_views, content_sessions, engagement_rate, session_duration
-                ) VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                date_map[row['date']],
-                row['page_title'],
-                row['page_views'],
-                row['sessions'],
-                row['engagement_rate'],
-                row['session_duration']
-            ))
-        
-        # Insert site data
-        for _, row in data['site'].iterrows():
-            cursor.execute('''
-                INSERT INTO site_data (
-                    date_id, search_Term, clicks, impressions
-                ) VALUES (?, ?, ?, ?)
-            ''', (
-                date_map[row['date']],
-                row['search_Term'],
-                row['clicks'],
-                row['impressions']
-            ))
+        # Dates and metrics are written in one explicit transaction
+        conn.execute("BEGIN")
+        try:
+            # Stream each dataset in batches into a temp staging table and a staged CSV export
+            for table, columns in CSV_HEADERS.items():
+                conn.execute(f"CREATE TEMP TABLE staging_{table} ({', '.join(columns)})")
+                stage_sql = f"INSERT INTO staging_{table} VALUES ({', '.join('?' * len(columns))})"
+                
+                with open(f"{table}_metrics.csv.tmp", 'w', newline='', encoding='utf-8') as f:
+                    writer = csv.writer(f, lineterminator='\n')
+                    writer.writerow(columns)
+                    
+                    for batch in chunks(data[table], batch_size):
+                        conn.executemany(stage_sql, batch)
+                        writer.writerows(batch)
+            
+            # Create missing date entries, oldest first
+            conn.execute(INSERT_DATES_SQL)
+            date_count = conn.execute(f"SELECT COUNT(*) FROM ({STAGED_DATES_SQL})").fetchone()[0]
+            
+            # On the initial load, build the date_id indexes once after inserting
+            if initial_load:
+                drop_date_id_indexes(conn)
+            
+            # Resolve date_ids by joining the staged rows against dates
+            conn.execute(INSERT_USERS_SQL)
+            conn.execute(INSERT_CONTENT_SQL)
+            conn.execute(INSERT_SITE_SQL)
+            
+            if initial_load:
+                create_date_id_indexes(conn)
+            
+            for table in CSV_HEADERS:
+                conn.execute(f"DROP TABLE staging_{table}")
+            
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            # Discard partially written CSV exports so the previous ones stay in place
+            for table in CSV_HEADERS:
+                try:
+                    os.remove(f"{table}_metrics.csv.tmp")
+                except FileNotFoundError:
+                    pass
+            raise
         
-        conn.commit()
-        logger.info(f"Successfully saved data for {len(all_dates)} dates")
+        logger.info(f"Successfully saved data for {date_count} dates")
         
-        # Export to CSV
+        # Publish the CSV exports now that the data is committed
         for table in ['users', 'content', 'site']:
-            data[table].to_csv(f"{table}_metrics.csv", index=False)
+            os.replace(f"{table}_metrics.csv.tmp", f"{table}_metrics.csv")
             
     except Exception as e:
-        conn.rollback()
         logger.error(f"Data save failed: {str(e)}")
         raise
-    finally:
-        conn.close()
 
-def get_last_date():
+def get_last_date(conn):
     """Get the last available date from database"""
-    conn = sqlite3.connect(CONFIG['database']['path'])
     cursor = conn.cursor()
     
     try:
         cursor.execute('''
-            SELECT MAX(date) FROM dates
+            SELECT date FROM dates ORDER BY date DESC LIMIT 1
         ''')
-        last_date = cursor.fetchone()[0]
+        result = cursor.fetchone()
+        last_date = result[0] if result else None
         
         if last_date:
             # Handle both formats during transition
@@ -307,19 +369,21 @@ def get_last_date():
     except Exception as e:
         logger.error(f"Date retrieval failed: {str(e)}")
         return None
-    finally:
-        conn.close()
 
 
 
 def main():
     """Main function to run the pipeline"""
     logger.info("Starting GA4 relational data pipeline")
-    init_db()
+    # Autocommit mode; transactions are opened and committed explicitly
+    conn = sqlite3.connect(CONFIG['database']['path'], isolation_level=None)
+    configure_connection(conn)
     
     try:
+        init_db(conn)
+        
         # Determine date range
-        last_date = get_last_date()
+        last_date = get_last_date(conn)
         end_date = datetime.now().date()
         
         if last_date:
@@ -337,16 +401,18 @@ def main():
             end_date.strftime('%Y-%m-%d')
         )
         
-        if not any(not df.empty for df in data.values()):
+        if not data:
             logger.info("No data returned from GA4 API")
             return
             
-        save_data(data)
+        save_data(conn, data)
         logger.info("Pipeline completed successfully")
         
     except Exception as e:
         logger.error(f"Pipeline failed: {str(e)}")
         exit(1)
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file